@@ -4,11 +4,13 @@ from setuptools import setup, find_packages
 install_requires = [
     'boto3',
     'click',
-    'polling',
-    'requests',
-    'paramiko'
+    'requests'
 ]
 
+extras_require = {
+    'ssh': ['paramiko']
+}
+
 test_requires = []
 
 
@@ -31,9 +33,10 @@ setup(
     keywords='aws ecs',
     long_description=read('README.md'),
     install_requires=install_requires,
+    extras_require=extras_require,
     tests_require=test_requires,
     package_dir={'': 'src'},
-    packages=find_packages('src'),
+    packages=find_packages('src', include=['ecs_cluster*']),
     include_package_data=True,
     entry_points={
         'console_scripts': {
@@ -1,64 +1,219 @@
+import logging
 import os
-import boto3
-from botocore.exceptions import ClientError
-import polling
-import requests
-import paramiko
-
+import random
+import re
+import shlex
+import shutil
+import socket
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from botocore.exceptions import ClientError, WaiterError
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on threads used to fan out independent AWS calls
+_MAX_WORKERS = 10
+
+# Upper bound on concurrent SSH sessions opened by docker_stats
+_MAX_SSH_WORKERS = 16
+
+# (connect, read) timeout in seconds for requests to the ECS agent
+_AGENT_TIMEOUT = (2, 5)
+
+# Seconds to wait on a stalled docker stats command before giving up
+_SSH_COMMAND_TIMEOUT = 30
+
+# Seconds allowed for each stage of an SSH handshake (TCP connect, banner,
+# auth) so one unresponsive host doesn't hold up docker_stats
+_SSH_CONNECT_TIMEOUT = 5
+
+# Shared by every boto3 client. The pool is sized for the concurrent
+# fan-out of AWS calls, keep-alive lets idle sockets survive between polls
+# and adaptive retries back off when throttled.
+_BOTO_CONFIG_OPTIONS = {
+    'max_pool_connections': 50,
+    'tcp_keepalive': True,
+    'connect_timeout': 5,
+    'read_timeout': 30,
+    'retries': {'max_attempts': 10, 'mode': 'adaptive'},
+}
+
+# boto3 clients by service name, shared by all ECSClient instances
+_CLIENTS = {}
+
+# Tag put on task definitions registered by this tool
+_MANAGED_TAG_VALUE = 'ecs-cluster'
+_MANAGED_TAG = [{'key': 'Managed', 'value': _MANAGED_TAG_VALUE}]
+
+# arn:aws:ecs:<region>:<account>:task-definition/<family>:<revision>
+_TASK_DEFINITION_ARN_RE = re.compile(
+    r'^arn:aws[^:]*:ecs:[^:]+:\d+:task-definition/([^:]+):\d+$')
+
+# Fields of a described task definition that register_task_definition
+# accepts. Everything else (revision, status, ARN...) is response-only.
+_REGISTER_TASK_DEFINITION_FIELDS = frozenset([
+    'family', 'taskRoleArn', 'executionRoleArn', 'networkMode',
+    'containerDefinitions', 'volumes', 'placementConstraints',
+    'requiresCompatibilities', 'cpu', 'memory', 'tags', 'pidMode', 'ipcMode',
+    'proxyConfiguration', 'inferenceAccelerators', 'ephemeralStorage',
+    'runtimePlatform'
+])
+
+# Maximum number of task definitions kept by each ECSClient's describe cache
+_TASKDEF_CACHE_SIZE = 1024
+
+# Longest wait, in seconds, between polls of a service being redeployed
+_MAX_POLL_STEP = 15
+
+# Minimum seconds between repeated progress messages while polling
+_POLL_LOG_INTERVAL = 5
+
+# Error codes from listing services that mean the cluster can't be read
+# with the current credentials, rather than a transient failure
+_SERVICE_LOOKUP_ERRORS = frozenset([
+    'ClusterNotFoundException', 'AccessDeniedException', 'AccessDenied'
+])
+
+# Seconds between checks of the services_stable waiter
+_WAITER_DELAY = 6
+
+# Maximum number of services accepted by a single describe_services call
+_DESCRIBE_SERVICES_MAX = 10
+
+# Maximum number of container instances accepted by a single
+# describe_container_instances call
+_DESCRIBE_CONTAINER_INSTANCES_MAX = 100
+
+# Maximum number of instance ids accepted by a single describe_instances call
+_DESCRIBE_INSTANCES_MAX = 1000
+
+
+def _batch_items(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _poll_with_backoff(predicate, timeout, initial=1.0, factor=1.8,
+                       cap=_MAX_POLL_STEP, message=None):
+    """
+    Call predicate until it returns True, backing off exponentially (with
+    jitter) between calls so fast changes are noticed quickly and slow ones
+    don't hammer the API. Returns False, without sleeping past it, once
+    timeout seconds would be exceeded.
+    """
+    delay = initial
+    deadline = time.monotonic() + timeout
+    next_log = 0
+    while not predicate():
+        now = time.monotonic()
+        if now + delay > deadline:
+            return False
+        # the first polls are only a second or two apart, don't log each one
+        if message and now >= next_log:
+            logger.info(message)
+            next_log = now + _POLL_LOG_INTERVAL
+        time.sleep(delay + random.uniform(0, delay * 0.25))
+        delay = min(delay * factor, cap)
+    return True
+
+
+@lru_cache(maxsize=None)
+def _get_session():
+    # Deferred so commands that never reach AWS (e.g. --help) don't pay
+    # for importing boto3
+    import boto3  # pylint: disable=import-outside-toplevel
+    return boto3.session.Session()
+
+
+@lru_cache(maxsize=None)
+def _get_agent_session():
+    # Pooled and retried, since the ECS agent can briefly refuse connections.
+    # Imported here as only ssh-service talks to the agent.
+    # pylint: disable=import-outside-toplevel
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(
+        pool_connections=16, pool_maxsize=16,
+        max_retries=Retry(total=2, backoff_factor=0.2,
+                          status_forcelist=[502, 503, 504])))
+    return session
+
+
+def _get_client(service_name):
+    if service_name not in _CLIENTS:
+        # botocore.config drags in most of botocore, so like boto3 it is
+        # only imported once a client is actually needed
+        from botocore.config import Config  # pylint: disable=import-outside-toplevel
+        _CLIENTS[service_name] = _get_session().client(
+            service_name, config=Config(**_BOTO_CONFIG_OPTIONS))
+    return _CLIENTS[service_name]
+
+
+class ServiceLookupError(Exception):
+    """
+    Raised when a cluster's services can't be listed with the current
+    credentials
+    """
 
-def _print_error(msg):
-    print('Error: ' + msg)
 
-class ECSClient:
+# One public method per ECS operation the CLI needs, so the count grows
+# with the commands rather than with any one method's complexity
+class ECSClient:  # pylint: disable=too-many-public-methods
     """
     Abstraction of the boto ecs client
     """
 
     def __init__(self, timeout=60):
-        self.ecs_client = boto3.client('ecs')
-        self.ec2_client = boto3.client('ec2')
+        self.ecs_client = _get_client('ecs')
+        self.ec2_client = _get_client('ec2')
         self.timeout = timeout
+        self._taskdef_cache = OrderedDict()
+        self._service_taskdef_cache = {}
+        self._ec2_details_cache = {}
 
     def redeploy_service_task(self, cluster_name, service_arn,
-                              old_taskdef_arn, new_taskdef_arn):
-        """ Redploys a service. This will stop the service's running task and
-            deregister it, then restart the service with the new task
-            definition.
+                              old_taskdef_arn, new_taskdef_arn, family=None):
+        """ Redploys a service. This will stop the service's running task,
+            restart the service with the new task definition and, once the
+            service is running again, deregister the old task definition.
+            Pass the old task definition's family if it is already known.
         """
-        # Deregister the old task definition
-        self.deregister_task_definition(old_taskdef_arn)
-
         # Stops tasks similar to the old task definition
         self.stop_tasks_similar_to_task_definition(
-            cluster_name, old_taskdef_arn)
+            cluster_name, old_taskdef_arn, family=family)
 
         service = self.update_service(cluster_name, service_arn, new_taskdef_arn)
         if not service:
-            _print_error("Unable to update the service %s with task %s" %
-                         (service_arn, new_taskdef_arn))
+            logger.error("Unable to update the service %s with task %s",
+                         service_arn, new_taskdef_arn)
             return False
 
-        def _echo_poll_step(step):
-            print('waiting for service to restart...')
-            return step
-
-        try:
-            polling.poll(
+        # A service scaled to zero has nothing to wait for
+        if service['desiredCount'] > 0 and not _poll_with_backoff(
                 lambda: self.redeploy_poll(cluster_name, service, service_arn),
-                step=5,
-                step_function=_echo_poll_step,
-                timeout=self.timeout
-            )
-
-        except polling.PollingException:
-            _print_error("Timeout or max tries exceeded")
+                self.timeout, message='waiting for service to restart...'):
+            logger.error("Timeout or max tries exceeded")
             return False
 
+        # Only deregister the old task definition once the service is running
+        # the new one, so a failed rollout can still be rolled back to it
+        if new_taskdef_arn != old_taskdef_arn:
+            self.deregister_task_definition(old_taskdef_arn)
+
         return True
 
     def redeploy_poll(self, cluster_name, service, service_arn):
-        running_count = self.get_service(cluster_name, service_arn)['runningCount']
-        return running_count == service['desiredCount']
+        """ Returns True once the service runs its desired number of tasks
+        """
+        # Only the count is kept from each (possibly large) describe response
+        services = self.ecs_client.describe_services(cluster=cluster_name,
+                                                     services=[service_arn])['services']
+        return bool(services) and services[0]['runningCount'] == service['desiredCount']
 
     def redeploy_image(self, cluster_name, service_arn, container_name, image_name):
         """ Redeploys a service while updating the image in its task
@@ -71,19 +226,18 @@ class ECSClient:
         """
         old_taskdef_arn = self.get_task_definition_arn(cluster_name, service_arn)
         if old_taskdef_arn is None:
-            _print_error(
-                "No task definition found for service " + service_arn)
+            logger.error("No task definition found for service %s", service_arn)
             return False
 
         new_taskdef_arn = self.clone_task(old_taskdef_arn,
                                           container_name,
                                           image_name)
         if new_taskdef_arn is None:
-            _print_error(
-                "Unable to clone the task definition " + old_taskdef_arn)
+            logger.error("Unable to clone the task definition %s", old_taskdef_arn)
             return False
 
-        self.ecs_client.tag_resource(resourceArn=new_taskdef_arn, tags=[{'key': 'Managed', 'value': 'ecs-cluster'}])
+        if new_taskdef_arn != old_taskdef_arn:
+            self.ecs_client.tag_resource(resourceArn=new_taskdef_arn, tags=_MANAGED_TAG)
 
         service = self.redeploy_service_task(cluster_name,
                                              service_arn,
@@ -92,20 +246,28 @@ class ECSClient:
         return service
 
     def update_image(self, cluster_name, service_arn, container_name,
-                     hostname, image_name, entrypoint=None, command=None):
+                     hostname, image_name, entrypoint=None, command=None,
+                     wait=False):
         """ Update the image in a task definition
 
             Same as redeploy_image, except the tasks won't be stopped. Instead,
             we'll let the ecs-agent do its thing and replace the tasks following
-            whatever deployment strategy is configured.
+            whatever deployment strategy is configured. With wait, returns
+            once the service is stable on the new task definition.
         """
-        latest_task_definition_arn = self.get_latest_task_definition_arn(cluster_name, service_arn)
-        latest_ecs_cluster_managed_task_definition_arn = self.get_latest_task_definition_arn(cluster_name, service_arn,
-                                                                                             search_tag='ecs-cluster')
+        current_taskdef_arn = self.get_task_definition_arn(cluster_name, service_arn)
+        if current_taskdef_arn is None:
+            logger.error("No task definition found for service %s", service_arn)
+            return False
+
+        family = self.get_task_family(current_taskdef_arn)
+        latest_task_definition_arn = self.get_latest_task_definition_arn(cluster_name, service_arn,
+                                                                         family=family)
+        latest_ecs_cluster_managed_task_definition_arn = self.get_latest_task_definition_arn(
+            cluster_name, service_arn, search_tag=_MANAGED_TAG_VALUE, family=family)
 
         if latest_task_definition_arn is None:
-            _print_error(
-                "No task definition found for service " + service_arn)
+            logger.error("No task definition found for service %s", service_arn)
             return False
 
         new_taskdef_arn = self.clone_task(latest_task_definition_arn,
@@ -115,54 +277,90 @@ class ECSClient:
                                           entrypoint,
                                           command)
         if new_taskdef_arn is None:
-            _print_error(
-                "Unable to clone the task definition " + latest_task_definition_arn)
+            logger.error("Unable to clone the task definition %s",
+                         latest_task_definition_arn)
             return False
 
-        self.ecs_client.tag_resource(resourceArn=new_taskdef_arn, tags=[{'key': 'Managed', 'value': 'ecs-cluster'}])
-        if latest_ecs_cluster_managed_task_definition_arn is not None:
+        if new_taskdef_arn != latest_task_definition_arn:
+            self.ecs_client.tag_resource(resourceArn=new_taskdef_arn, tags=_MANAGED_TAG)
+        if latest_ecs_cluster_managed_task_definition_arn not in (None, new_taskdef_arn):
             self.deregister_task_definition(latest_ecs_cluster_managed_task_definition_arn)
 
-        service = self.update_service(cluster_name, service_arn, new_taskdef_arn)
+        # An unchanged revision may still point at a mutable tag (e.g. latest)
+        # that has since moved, so force a new deployment to pull it again
+        service = self.update_service(cluster_name, service_arn, new_taskdef_arn,
+                                      wait=wait,
+                                      force=new_taskdef_arn == current_taskdef_arn)
         if not service:
-            _print_error("Unable to update the service %s with task %s"
-                         % (service_arn, new_taskdef_arn))
+            logger.error("Unable to update the service %s with task %s",
+                         service_arn, new_taskdef_arn)
             return False
 
         return True
 
+    def iter_services(self, cluster_name):
+        """ Yields the ARN of each service in the cluster, fetching pages
+            only as they are consumed. Raises ServiceLookupError if the
+            cluster can't be read with the current credentials.
+        """
+        paginator = self.ecs_client.get_paginator('list_services')
+        try:
+            for page in paginator.paginate(cluster=cluster_name, maxResults=100):
+                yield from page['serviceArns']
+        except ClientError as error:
+            # Anything else (e.g. throttling that outlasted the SDK's own
+            # retries) is unexpected and shouldn't look like an empty cluster
+            if error.response['Error']['Code'] not in _SERVICE_LOOKUP_ERRORS:
+                raise
+            raise ServiceLookupError(cluster_name) from error
+
     def get_services(self, cluster_name):
         """ Returns the ARN of all services found for the cluster
         """
         try:
-            response = self.ecs_client.list_services(cluster=cluster_name,
-                                                     maxResults=100)
-        except ClientError:
-            _print_error(
-                "Error getting list of services for %s" % cluster_name)
+            return list(self.iter_services(cluster_name))
+        except ServiceLookupError:
+            logger.error("Error getting list of services for %s", cluster_name)
             return None
-        return response['serviceArns']
+
+    def _describe_services_batched(self, cluster_name, service_arns):
+        """ Returns the service objects for all of the service ARNs,
+            describing them in batches of the API maximum of 10
+        """
+        services = []
+        for batch in _batch_items(service_arns, _DESCRIBE_SERVICES_MAX):
+            response = self.ecs_client.describe_services(cluster=cluster_name,
+                                                         services=batch)
+            services.extend(response['services'])
+        return services
 
     def get_service(self, cluster_name, service_arn):
-        """ Returns the service object matching the service ARN
+        """ Returns the service object matching the service ARN. A plain
+            service name is matched against serviceName as well, since
+            describe_services accepts either (get-images passes a name).
         """
-        response = self.ecs_client.describe_services(cluster=cluster_name,
-                                                     services=[service_arn])
-        if response is None or not response['services']:
+        services = self._describe_services_batched(cluster_name, [service_arn])
+        if not services:
             return None
-        for service in response['services']:
-            if service['serviceArn'] == service_arn:
-                return service
 
-        _print_error("No service for cluster %s matches %s" %
-                     (cluster_name, service_arn))
+        # Only one service was asked for, so it can only be the first
+        service = services[0]
+        if service_arn in (service['serviceArn'], service['serviceName']):
+            return service
+
+        logger.error("No service for cluster %s matches %s",
+                     cluster_name, service_arn)
         return None
 
     def get_task_family(self, taskdef_arn):
         """ Returns the family of a task definition
         """
-        response = self.ecs_client.describe_task_definition(
-            taskDefinition=taskdef_arn)
+        # Full ARNs carry the family, so no API call is needed for them
+        match = _TASK_DEFINITION_ARN_RE.match(taskdef_arn)
+        if match:
+            return match.group(1)
+
+        response = self._describe_task_definition(taskdef_arn)
         if response is None or 'taskDefinition' not in response:
             return ''
         return response['taskDefinition']['family']
@@ -178,33 +376,45 @@ class ECSClient:
         """ Returns the ARN of the task definition which matches the
             service name
         """
+        key = (cluster_name, service_arn)
+        if key in self._service_taskdef_cache:
+            return self._service_taskdef_cache[key]
+
         service = self.get_service(cluster_name, service_arn)
         if service is not None:
+            self._service_taskdef_cache[key] = service['taskDefinition']
             return service['taskDefinition']
         return None
 
-    def get_latest_task_definition_arn(self, cluster_name, service_name, search_tag=''):
-
-        active_arn = self.get_task_definition_arn(cluster_name, service_name)
-        family = self.get_task_family(active_arn)
+    def get_task_definition_arns(self, cluster_name, service_arns):
+        """ Returns a dict of service ARN to the ARN of its task definition,
+            for all of the service ARNs
+        """
+        taskdef_arns = {service['serviceArn']: service['taskDefinition']
+                        for service in self._describe_services_batched(
+                            cluster_name, service_arns)}
+        for service_arn, taskdef_arn in taskdef_arns.items():
+            self._service_taskdef_cache[(cluster_name, service_arn)] = taskdef_arn
+        return taskdef_arns
+
+    def get_latest_task_definition_arn(self, cluster_name, service_name, search_tag='',
+                                       family=None):
+        """ Returns the ARN of the newest active revision in the service's
+            task definition family, or the newest one tagged Managed=search_tag.
+            The service is only looked up when family isn't given.
+        """
+        if family is None:
+            active_arn = self.get_task_definition_arn(cluster_name, service_name)
+            family = self.get_task_family(active_arn)
 
-        # for task in tasks:
-        response = self.ecs_client.list_task_definitions(
-            familyPrefix=family,
-            status='ACTIVE',
-            sort='DESC'
-        )
+        list_kwargs = {'familyPrefix': family, 'status': 'ACTIVE', 'sort': 'DESC'}
         if not search_tag:
-            latest_arn = response['taskDefinitionArns'][0]
-            return latest_arn
-
-        for task_definition_arn in response['taskDefinitionArns']:
-            tags = self.ecs_client.list_tags_for_resource(resourceArn=task_definition_arn).get('tags')
-            for tag in tags:
-                if tag['key'] == 'Managed' and tag['value'] == search_tag:
-                    return task_definition_arn
-        print("Unable to find a task definition that is tagged 'Managed=%s', returning 'None'" % search_tag)
-        return None
+            # Only the newest revision is needed
+            response = self.ecs_client.list_task_definitions(maxResults=1,
+                                                             **list_kwargs)
+            return response['taskDefinitionArns'][0]
+
+        return self._find_tagged_task_definition(list_kwargs, search_tag)
 
     def register_task_definition(self, register_kwargs):
         response = self.ecs_client.register_task_definition(**register_kwargs)
@@ -213,100 +423,146 @@ class ECSClient:
         return new_task_definition_arn
 
     def get_task_images(self, task_definition_arn):
-        response = self.ecs_client.describe_task_definition(
-            taskDefinition=task_definition_arn)
+        response = self._describe_task_definition(task_definition_arn)
         return [{'container': x['name'], 'image': x['image']} for x in
                 response['taskDefinition']['containerDefinitions']]
 
-    def clone_task(self, task_definition_arn, container_name, image_name,
+    def clone_task(self, task_definition_arn, container_name, image_name=None,
                    hostname=None, entrypoint=None, command=None):
         """ Clones a task and sets its image attribute. Returns the new
-            task definition arn if successful, otherwise None
+            task definition arn if successful, otherwise None. If the
+            containers already have the requested settings, no new revision
+            is registered and task_definition_arn is returned as is.
+
+            container_name may also be a dict of container name to image
+            name, to update several containers in a single new revision.
+            Otherwise image_name is required.
         """
-        response = self.ecs_client.describe_task_definition(
-            taskDefinition=task_definition_arn)
+        response = self._describe_task_definition(task_definition_arn)
 
         if response is None or 'taskDefinition' not in response:
             return None
 
-        task_def = response['taskDefinition']
-        containers = task_def['containerDefinitions']
-
-        # Update the image in the container
-        for container in containers:
-            if container['name'] == container_name:
-                container['image'] = image_name
-                if hostname is not None:
-                    container['hostname'] = hostname
-                if entrypoint is not None:
-                    container['entryPoint'] = entrypoint.split()
-                if command is not None:
-                    container['command'] = command.split()
-        task_def['containerDefinitions'] = containers
-
-        # Remove fields not required for new task def
-        task_def.pop('revision')
-        task_def.pop('status')
-        task_def.pop('taskDefinitionArn')
-        task_def.pop('compatibilities')
-        task_def.pop('requiresAttributes')
-
-        return self.register_task_definition(task_def)
-
-    def update_service(self, cluster_name, service_name, task_definition_arn):
+        if isinstance(container_name, dict):
+            images = container_name
+        elif image_name is None:
+            logger.error("No image given for container %s", container_name)
+            return None
+        else:
+            images = {container_name: image_name}
+
+        settings = {}
+        if hostname is not None:
+            settings['hostname'] = hostname
+        if entrypoint is not None:
+            settings['entryPoint'] = entrypoint.split()
+        if command is not None:
+            settings['command'] = command.split()
+
+        register_kwargs, missing = self._copy_task_definition(
+            response['taskDefinition'], images, settings)
+        if missing:
+            logger.error("No container %s in task definition %s",
+                         ', '.join(sorted(missing)), task_definition_arn)
+            return None
+
+        if register_kwargs is None:
+            return task_definition_arn
+
+        return self.register_task_definition(register_kwargs)
+
+    def update_service(self, cluster_name, service_name, task_definition_arn,
+                       wait=False, force=False):
         """ Updates the service with a different task definition. Returns
-            the service response if successful, otherwise None
+            the service response if successful, otherwise None. With wait,
+            also waits (up to the client timeout) for the service to become
+            stable on the new task definition. With force, a new deployment
+            is started even if the task definition is unchanged.
         """
+        # The service's task definition is about to change
+        self._service_taskdef_cache.pop((cluster_name, service_name), None)
+
         response = self.ecs_client.update_service(cluster=cluster_name,
                                                   service=service_name,
-                                                  taskDefinition=task_definition_arn)
+                                                  taskDefinition=task_definition_arn,
+                                                  forceNewDeployment=force)
         if response is None or 'service' not in response \
                 or response['service']['status'] != 'ACTIVE':
-            return False
+            return None
 
-        return True
+        if wait:
+            waiter = self.ecs_client.get_waiter('services_stable')
+            try:
+                waiter.wait(cluster=cluster_name, services=[service_name],
+                            WaiterConfig={
+                                'Delay': _WAITER_DELAY,
+                                'MaxAttempts': max(1, self.timeout // _WAITER_DELAY)
+                            })
+            except WaiterError:
+                logger.error("Timeout or max tries exceeded")
+                return None
+
+        return response['service']
 
     def deregister_task_definition(self, task_definition_arn):
-        """ Deregisters the specified task definition. Returns the task
-            definition if successful, None otherwise
+        """ Deregisters the specified task definition. Returns its ARN and
+            status if successful, None otherwise
         """
+        # Its cached description would still report it as ACTIVE
+        self._taskdef_cache.pop(task_definition_arn, None)
+
         response = self.ecs_client.deregister_task_definition(
             taskDefinition=task_definition_arn)
         if response is None or 'taskDefinition' not in response \
                 or response['taskDefinition'].get('status', None) != 'INACTIVE':
             return None
 
-        return response['taskDefinition']
+        # Don't hold on to the full definition (container definitions and all)
+        task_def = response['taskDefinition']
+        return {'taskDefinitionArn': task_def['taskDefinitionArn'],
+                'status': task_def['status']}
 
-    def stop_tasks_similar_to_task_definition(self, cluster_name, task_definition):
+    def stop_tasks_similar_to_task_definition(self, cluster_name, task_definition,
+                                              family=None):
         """ Stops all running tasks similar a task definition. Similarity
             is measured by the task definition family name. If two task definition
             arns only vary by the revision, they will have the same family
-            Returns the stopped tasks if successful, None otherwise
+            Returns the stopped tasks if successful, None otherwise. The task
+            definition is only described when its family isn't given.
         """
-        response = self.ecs_client.describe_task_definition(
-            taskDefinition=task_definition)
-
-        if response is None or 'taskDefinition' not in response:
-            return None
-
-        family = response['taskDefinition']['family']
-
-        response = self.ecs_client.list_tasks(cluster=cluster_name,
-                                              family=family,
-                                              desiredStatus='RUNNING')
-        if response is None or 'taskArns' not in response:
-            _print_error("No running tasks found")
-            return None
+        if family is None:
+            family = self.get_task_family(task_definition)
+            if not family:
+                return None
+
+        paginator = self.ecs_client.get_paginator('list_tasks')
+        task_arns = [task_arn
+                     for page in paginator.paginate(cluster=cluster_name,
+                                                    family=family,
+                                                    desiredStatus='RUNNING')
+                     for task_arn in page['taskArns']]
+        if not task_arns:
+            return []
+
+        stop_task = self.ecs_client.stop_task
+
+        def _stop_task(task_arn):
+            # One task failing to stop shouldn't abort stopping the others
+            try:
+                return stop_task(cluster=cluster_name, task=task_arn)
+            except ClientError:
+                return None
+
+        # stop_task calls are independent, so issue them concurrently
+        with ThreadPoolExecutor(
+                max_workers=min(_MAX_WORKERS, len(task_arns))) as executor:
+            responses = list(executor.map(_stop_task, task_arns))
 
         stopped = []
-
-        for task_arn in response['taskArns']:
-            response = self.ecs_client.stop_task(
-                cluster=cluster_name, task=task_arn)
-
+        for task_arn, response in zip(task_arns, responses):
             if response is None or 'task' not in response:
-                _print_error("Could not stop task %s" % task_arn)
+                logger.error("Could not stop task %s", task_arn)
+                continue
 
             stopped.append(response['task'])
 
@@ -325,45 +581,73 @@ class ECSClient:
 
     # pylint: disable=too-many-locals
     def docker_stats(self, cluster_name, ssh_keydir, user, key_name):
-        arns = self.ecs_client.list_container_instances(cluster=cluster_name)["containerInstanceArns"]
-        host_ids = [x["ec2InstanceId"] for x in self.ecs_client.describe_container_instances(
-            cluster=cluster_name, containerInstances=arns)["containerInstances"]]
-        hosts = [self._get_ec2_details(x) for x in host_ids]
+        try:
+            import paramiko  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            logger.error("docker-stats requires paramiko, install it with "
+                         "'pip install ecs-cluster[ssh]'")
+            return
+
+        host_ids = [x["ec2InstanceId"] for x in self._get_container_instances(cluster_name)]
+        hosts = self._get_ec2_details_bulk(host_ids)
+        if not hosts:
+            return
+
+        # Parse known_hosts once rather than once per host
+        known_hosts = paramiko.HostKeys()
+        try:
+            known_hosts.load(os.path.expanduser('~/.ssh/known_hosts'))
+        except IOError:
+            pass
 
-        for host in hosts:
+        def _collect_stats(host):
             if 'PublicIpAddress' in host:
                 ip_address = host['PublicIpAddress']
             else:
                 ip_address = host['PrivateIpAddress']
 
-            if key_name is None:
-                key_name = host['KeyName']
-
-            pem_file = self._get_ssh_key(ssh_keydir, key_name)
+            pem_file = self._get_ssh_key(ssh_keydir, key_name or host['KeyName'])
             command = "sudo docker stats --no-stream --no-trunc"
             ssh_client = paramiko.SSHClient()
-            ssh_client.load_system_host_keys()
+            ssh_client.get_host_keys().update(known_hosts)
             ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
-            ssh_client.connect(hostname=ip_address,
-                               username=user,
-                               key_filename=pem_file)
 
-            print('Host ' + ip_address)
-
-            # pylint: disable=unused-variable
-            stdin, stdout, stderr = ssh_client.exec_command(command)
-            for line in stdout:
-                print(line.strip('\n'))
-            ssh_client.close()
+            try:
+                ssh_client.connect(hostname=ip_address,
+                                   username=user,
+                                   key_filename=pem_file,
+                                   timeout=_SSH_CONNECT_TIMEOUT,
+                                   banner_timeout=_SSH_CONNECT_TIMEOUT,
+                                   auth_timeout=_SSH_CONNECT_TIMEOUT)
+                ssh_client.get_transport().set_keepalive(30)
+                # pylint: disable=unused-variable
+                stdin, stdout, stderr = ssh_client.exec_command(command)
+                # --no-stream prints a single table, so read it in one go
+                stdout.channel.settimeout(_SSH_COMMAND_TIMEOUT)
+                output = stdout.read().decode()
+            except (paramiko.SSHException, socket.timeout, OSError) as error:
+                # Report the host and carry on, so one unreachable or slow
+                # host doesn't lose the stats already collected from the rest
+                return 'Host %s: %s\n' % (ip_address, str(error) or type(error).__name__)
+            finally:
+                ssh_client.close()
+            return 'Host %s\n%s' % (ip_address, output)
+
+        # SSH sessions are I/O bound, so collect from all hosts at once and
+        # print the results in host order so output isn't interleaved
+        with ThreadPoolExecutor(
+                max_workers=min(_MAX_SSH_WORKERS, len(hosts))) as executor:
+            for host_output in executor.map(_collect_stats, hosts):
+                sys.stdout.write(host_output)
 
     # pylint: disable=too-many-locals
     def ssh_to_service(self, cluster_name, service_arn, task_arn,
                        ssh_user, ssh_key_dir, service_cmd, key_name, container_name):
         service = self.get_service(cluster_name, service_arn)
         if service is None:
-            _print_error(
-                "Could not find service %s in cluster %s" % (service_arn, cluster_name))
-            return None
+            logger.error("Could not find service %s in cluster %s",
+                         service_arn, cluster_name)
+            return
 
         if not task_arn:
             task_arn = self.get_task_arn(cluster_name, service_arn)
@@ -381,14 +665,18 @@ class ECSClient:
         pem_file = self._get_ssh_key(ssh_key_dir, key_name)
 
         container_id = self._find_container_id(ip_address, task_arn, container_name)
+        # No local shell runs the command any more, so size the remote
+        # terminal from ours here rather than with `tput` substitutions
+        columns, lines = shutil.get_terminal_size()
         docker_cmd = 'sudo docker exec ' \
                      '-e SSH_USER={} ' \
-                     '-e COLUMNS="`tput cols`" ' \
-                     '-e LINES="`tput lines`" -it {} {}'.format(ssh_user, container_id, service_cmd)
-        system_cmd = 'ssh -t -o StrictHostKeyChecking=no ' \
-                     '-o TCPKeepAlive=yes ' \
-                     '-o ServerAliveInterval=50 -i {} {}@{} {}' \
-            .format(pem_file, ssh_user, ip_address, docker_cmd)
+                     '-e COLUMNS={} ' \
+                     '-e LINES={} -it {} {}'.format(ssh_user, columns, lines,
+                                                    container_id, service_cmd)
+        ssh_args = ['ssh', '-t', '-o', 'StrictHostKeyChecking=no',
+                    '-o', 'TCPKeepAlive=yes',
+                    '-o', 'ServerAliveInterval=50', '-i', pem_file,
+                    '{}@{}'.format(ssh_user, ip_address), docker_cmd]
 
         print("==========================================================")
         print(' Container Id {}'.format(container_id))
@@ -397,13 +685,84 @@ class ECSClient:
         print(' IP Address {}'.format(ip_address))
         print(' Key {}'.format(pem_file))
         print(' Docker Command {}'.format(docker_cmd))
-        print(' Full Command {}'.format(system_cmd))
+        print(' Full Command {}'.format(' '.join(shlex.quote(arg) for arg in ssh_args)))
         print("==========================================================")
 
-        os.system(system_cmd)
+        # Replace this process with ssh, flushing first so the banner isn't lost
+        sys.stdout.flush()
+        os.execvp('ssh', ssh_args)
 
+    @staticmethod
+    def _copy_task_definition(task_def, images, settings):
+        """ Returns the register_task_definition arguments for a copy of
+            task_def with the given images and settings applied (None if
+            nothing would change), and the names in images that matched no
+            container
+        """
+        containers = list(task_def['containerDefinitions'])
+        found = set()
+        changed = False
+        for index, container in enumerate(containers):
+            if container['name'] not in images:
+                continue
+            found.add(container['name'])
+            updates = dict(settings, image=images[container['name']])
+            if any(container.get(key) != value for key, value in updates.items()):
+                # Copied so the cached describe response isn't mutated
+                containers[index] = dict(container, **updates)
+                changed = True
+
+        missing = set(images) - found
+        if missing or not changed:
+            return None, missing
+
+        # Only keep the fields register_task_definition accepts
+        register_kwargs = {key: value for key, value in task_def.items()
+                           if key in _REGISTER_TASK_DEFINITION_FIELDS}
+        register_kwargs['containerDefinitions'] = containers
+        return register_kwargs, missing
+
+    def _find_tagged_task_definition(self, list_kwargs, search_tag):
+        """ Returns the ARN of the newest task definition listed with
+            list_kwargs that is tagged Managed=search_tag, or None
+        """
+        def _list_tags(task_definition_arn):
+            return self.ecs_client.list_tags_for_resource(resourceArn=task_definition_arn).get('tags')
+
+        # Pages are only fetched until a tagged revision turns up, which may
+        # be further back than the first page. Tags are looked up a window
+        # of revisions at a time, newest first, so the newest match wins.
+        paginator = self.ecs_client.get_paginator('list_task_definitions')
+        with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+            for page in paginator.paginate(**list_kwargs):
+                for batch in _batch_items(page['taskDefinitionArns'], _MAX_WORKERS):
+                    for task_definition_arn, tags in zip(batch, executor.map(_list_tags, batch)):
+                        tag_map = {tag['key']: tag['value'] for tag in tags or []}
+                        if tag_map.get('Managed') == search_tag:
+                            return task_definition_arn
+        logger.info("Unable to find a task definition that is tagged 'Managed=%s', returning 'None'", search_tag)
         return None
 
+    def _describe_task_definition(self, task_definition):
+        """ Returns the describe_task_definition response for a task
+            definition. Registered revisions are immutable, so responses are
+            cached when looked up by full ARN. Family names (with or without
+            a revision) are always fetched since they may resolve to a newer
+            revision.
+        """
+        if task_definition in self._taskdef_cache:
+            self._taskdef_cache.move_to_end(task_definition)
+            return self._taskdef_cache[task_definition]
+
+        response = self.ecs_client.describe_task_definition(
+            taskDefinition=task_definition)
+        if response is not None and task_definition.startswith('arn:'):
+            self._taskdef_cache[task_definition] = response
+            # Evict the least recently used entries beyond the size cap
+            while len(self._taskdef_cache) > _TASKDEF_CACHE_SIZE:
+                self._taskdef_cache.popitem(last=False)
+        return response
+
     def _get_ec2_arn(self, cluster_name, service_arn, task_arn):
         if service_arn:
             instances = self._get_service_container_instances(
@@ -430,14 +789,20 @@ class ECSClient:
         return response['containerInstances']
 
     def _get_container_instances(self, cluster_name):
-        arns = self.ecs_client.list_container_instances(
-            cluster=cluster_name)['containerInstanceArns']
-        response = self.ecs_client.describe_container_instances(
-            cluster=cluster_name,
-            containerInstances=arns
-        )
+        paginator = self.ecs_client.get_paginator('list_container_instances')
+        arns = [arn
+                for page in paginator.paginate(cluster=cluster_name)
+                for arn in page['containerInstanceArns']]
+
+        instances = []
+        for batch in _batch_items(arns, _DESCRIBE_CONTAINER_INSTANCES_MAX):
+            response = self.ecs_client.describe_container_instances(
+                cluster=cluster_name,
+                containerInstances=batch
+            )
+            instances.extend(response['containerInstances'])
 
-        return response['containerInstances']
+        return instances
 
     @staticmethod
     def _find_container_id(ip_address, task_arn, container_name=None):
@@ -446,12 +811,12 @@ class ECSClient:
         which is needed during the docker exec phase
         """
         url = 'http://%s:51678/v1/tasks' % ip_address
-        response = requests.get(url=url)
+        response = _get_agent_session().get(url, timeout=_AGENT_TIMEOUT)
 
         data = response.json()
         tasks = [task for task in data['Tasks'] if task['Arn'] == task_arn]
         if not tasks:
-            _print_error("No container found for task %s" % task_arn)
+            logger.error("No container found for task %s", task_arn)
             return None
 
         if container_name is not None:
@@ -462,14 +827,28 @@ class ECSClient:
         return [container['DockerId'] for container in tasks[0]['Containers']][0]
 
     def _get_ec2_details(self, ec2_arn):
-        ids = [ec2_arn]
-        response = self.ec2_client.describe_instances(InstanceIds=ids)
-        details = response['Reservations'][0]['Instances'][0]
-        return details
+        return self._get_ec2_details_bulk([ec2_arn])[0]
+
+    def _get_ec2_details_bulk(self, instance_ids):
+        """
+        Describe many EC2 instances with as few describe_instances calls
+        as possible. Instances already described by this client are reused.
+        """
+        missing = [x for x in instance_ids if x not in self._ec2_details_cache]
+        for batch in _batch_items(missing, _DESCRIBE_INSTANCES_MAX):
+            response = self.ec2_client.describe_instances(InstanceIds=batch)
+            for reservation in response['Reservations']:
+                for instance in reservation['Instances']:
+                    self._ec2_details_cache[instance['InstanceId']] = instance
+        return [self._ec2_details_cache[x] for x in instance_ids]
 
     @staticmethod
+    @lru_cache(maxsize=64)
     def _get_ssh_key(key_dir, key_name):
-
+        """
+        Resolve the path of an ssh key. The result is cached per
+        (key_dir, key_name) since docker_stats asks once per host.
+        """
         home = os.environ['HOME']
         path = os.path.join(home, key_dir, key_name)
         if not os.path.exists(path):
@@ -477,7 +856,7 @@ class ECSClient:
         if not os.path.exists(path):
             path = os.path.join(home, key_dir, 'id_rsa')
             if os.path.exists(path):
-                print('\n*** Warning, could not find the specified ssh key, falling back to %s ***\n' % path)
+                logger.warning('could not find the specified ssh key, falling back to %s', path)
             else:
                 raise FileNotFoundError('Could not find valid ssh key')
 
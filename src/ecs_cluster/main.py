@@ -1,23 +1,26 @@
 from __future__ import print_function
 
 import json
+import logging
 import sys
 import click
 
-from .ecs_client import ECSClient
+from .ecs_client import ECSClient, ServiceLookupError
 
 def _get_service_arn(ecs_client, cluster, service):
     service_arn = None
     if service is not None:
-        services = ecs_client.get_services(cluster)
-        if services is None:
+        # match on the trailing name so both the short and the long
+        # (cluster-qualified) ARN formats resolve. Stopping at the first
+        # hit also stops fetching further pages of services.
+        suffix = '/' + service
+        try:
+            service_arn = next((arn for arn in ecs_client.iter_services(cluster)
+                                if arn.endswith(suffix)), None)
+        except ServiceLookupError:
             click.echo(
                 'Could not get ECS services. Check AWS credentials', err=True)
             sys.exit(1)
-        matches = [arn for arn in services
-                   if service == arn.split('/', 1)[1]]
-        if matches:
-            service_arn = matches[0]
     return service_arn
 
 # pylint: disable=unused-argument
@@ -32,6 +35,15 @@ def _get_cli_stdin(ctx, param, value):
 @click.option("--timeout", required=False, type=int, default=60)
 @click.pass_context
 def cli(ctx, timeout):
+    # Only this package's messages go out at INFO, so library chatter
+    # (botocore credential lookups, paramiko handshakes) stays hidden
+    package_logger = logging.getLogger('ecs_cluster')
+    if not package_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        package_logger.addHandler(handler)
+        package_logger.propagate = False
+    package_logger.setLevel(logging.INFO)
     ctx.obj = {'timeout': timeout}
 
 
@@ -41,9 +53,11 @@ def cli(ctx, timeout):
 def list_services(ctx, cluster):
     ecs_client = ECSClient(timeout=ctx.obj['timeout'])
     click.echo('-- services for %s --' % cluster)
-    for service in ecs_client.get_services(cluster) or []:
+    services = ecs_client.get_services(cluster) or []
+    active_task_arns = ecs_client.get_task_definition_arns(cluster, services)
+    for service in services:
         click.echo('    %s' % service)
-        active_task_arn = ecs_client.get_task_definition_arn(cluster, service)
+        active_task_arn = active_task_arns.get(service)
         latest_task_arn = ecs_client.get_latest_task_definition_arn(cluster, service)
         click.echo('        active: %s' % active_task_arn)
         click.echo('        latest: %s' % latest_task_arn)
@@ -63,9 +77,11 @@ def list_services(ctx, cluster):
               help="Force task restart after update. Defaults to false.")
 @click.option("--latest", is_flag=True, default=False,
               help="Update the latest task definition, even if it's not the one currently in use")
+@click.option("--wait", is_flag=True, default=False,
+              help="Wait for the service to become stable after the update. Defaults to false.")
 @click.pass_context
 def update_image(ctx, cluster, service, hostname, command, entrypoint,
-                 container, image, restart, latest):
+                 container, image, restart, latest, wait):
     ecs_client = ECSClient(timeout=ctx.obj['timeout'])
     service_arn = _get_service_arn(ecs_client, cluster, service)
 
@@ -79,7 +95,8 @@ def update_image(ctx, cluster, service, hostname, command, entrypoint,
             cluster, service_arn, container, image)
     else:
         service = ecs_client.update_image(
-            cluster, service_arn, container, hostname, image, entrypoint, command)
+            cluster, service_arn, container, hostname, image, entrypoint, command,
+            wait=wait)
 
     if service:
         click.echo('Success')
@@ -111,7 +128,8 @@ def update_taskdef(ctx, cluster, service, taskdef_text):
     service = ecs_client.redeploy_service_task(cluster,
                                                service_arn,
                                                old_taskdef_arn,
-                                               new_taskdef_arn)
+                                               new_taskdef_arn,
+                                               family=taskdef['family'])
 
     if service:
         click.echo('Success')
@@ -0,0 +1,246 @@
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from ecs_cluster import ecs_client
+from ecs_cluster.ecs_client import ECSClient, ServiceLookupError
+
+TASKDEF_ARN = 'arn:aws:ecs:us-east-1:123456789012:task-definition/web:3'
+NEW_TASKDEF_ARN = 'arn:aws:ecs:us-east-1:123456789012:task-definition/web:4'
+
+
+def _make_client():
+    with mock.patch.object(ecs_client, '_get_client'):
+        client = ECSClient()
+    client.ecs_client = mock.MagicMock()
+    return client
+
+
+def _client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'ListServices')
+
+
+def _describe_response(containers):
+    return {'taskDefinition': {
+        'taskDefinitionArn': TASKDEF_ARN,
+        'family': 'web',
+        'revision': 3,
+        'status': 'ACTIVE',
+        'containerDefinitions': containers,
+    }}
+
+
+class CloneTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = _make_client()
+        self.containers = [{'name': 'web', 'image': 'web:1'},
+                           {'name': 'worker', 'image': 'worker:1'}]
+        self.client.ecs_client.describe_task_definition.return_value = \
+            _describe_response(self.containers)
+        self.client.ecs_client.register_task_definition.return_value = {
+            'taskDefinition': {'taskDefinitionArn': NEW_TASKDEF_ARN}}
+
+    def test_unchanged_image_returns_same_arn(self):
+        arn = self.client.clone_task(TASKDEF_ARN, 'web', 'web:1')
+
+        self.assertEqual(arn, TASKDEF_ARN)
+        self.client.ecs_client.register_task_definition.assert_not_called()
+
+    def test_changed_image_registers_whitelisted_fields(self):
+        arn = self.client.clone_task(TASKDEF_ARN, 'web', 'web:2')
+
+        self.assertEqual(arn, NEW_TASKDEF_ARN)
+        register_kwargs = self.client.ecs_client.register_task_definition.call_args[1]
+        self.assertEqual(register_kwargs['family'], 'web')
+        self.assertNotIn('revision', register_kwargs)
+        self.assertNotIn('status', register_kwargs)
+        self.assertEqual(register_kwargs['containerDefinitions'],
+                         [{'name': 'web', 'image': 'web:2'},
+                          {'name': 'worker', 'image': 'worker:1'}])
+        # the cached describe response must not be modified
+        self.assertEqual(self.containers[0]['image'], 'web:1')
+
+    def test_container_dict_updates_all_in_one_revision(self):
+        arn = self.client.clone_task(TASKDEF_ARN, {'web': 'web:2', 'worker': 'worker:2'})
+
+        self.assertEqual(arn, NEW_TASKDEF_ARN)
+        self.client.ecs_client.register_task_definition.assert_called_once()
+        register_kwargs = self.client.ecs_client.register_task_definition.call_args[1]
+        self.assertEqual([c['image'] for c in register_kwargs['containerDefinitions']],
+                         ['web:2', 'worker:2'])
+
+    def test_unknown_container_returns_none(self):
+        self.assertIsNone(self.client.clone_task(TASKDEF_ARN, {'web': 'web:2', 'db': 'db:1'}))
+        self.client.ecs_client.register_task_definition.assert_not_called()
+
+    def test_missing_image_returns_none(self):
+        self.assertIsNone(self.client.clone_task(TASKDEF_ARN, 'web'))
+        self.client.ecs_client.register_task_definition.assert_not_called()
+
+
+class DescribeTaskDefinitionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = _make_client()
+        self.client.ecs_client.describe_task_definition.side_effect = \
+            lambda taskDefinition: {'taskDefinition': {'taskDefinitionArn': taskDefinition}}
+
+    def test_arns_are_cached(self):
+        self.client._describe_task_definition(TASKDEF_ARN)
+        self.client._describe_task_definition(TASKDEF_ARN)
+
+        self.assertEqual(self.client.ecs_client.describe_task_definition.call_count, 1)
+
+    def test_family_names_are_not_cached(self):
+        self.client._describe_task_definition('web')
+        self.client._describe_task_definition('web')
+
+        self.assertEqual(self.client.ecs_client.describe_task_definition.call_count, 2)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        with mock.patch.object(ecs_client, '_TASKDEF_CACHE_SIZE', 2):
+            self.client._describe_task_definition(TASKDEF_ARN + '1')
+            self.client._describe_task_definition(TASKDEF_ARN + '2')
+            # touch the first entry so the second is the oldest
+            self.client._describe_task_definition(TASKDEF_ARN + '1')
+            self.client._describe_task_definition(TASKDEF_ARN + '3')
+
+        self.assertEqual(list(self.client._taskdef_cache),
+                         [TASKDEF_ARN + '1', TASKDEF_ARN + '3'])
+
+    def test_deregister_evicts_entry(self):
+        self.client._describe_task_definition(TASKDEF_ARN)
+        self.client.deregister_task_definition(TASKDEF_ARN)
+
+        self.assertNotIn(TASKDEF_ARN, self.client._taskdef_cache)
+
+
+class GetServicesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = _make_client()
+        self.paginator = self.client.ecs_client.get_paginator.return_value
+
+    def test_pages_are_joined(self):
+        self.paginator.paginate.return_value = [{'serviceArns': ['a', 'b']},
+                                                {'serviceArns': ['c']}]
+
+        self.assertEqual(self.client.get_services('cluster'), ['a', 'b', 'c'])
+
+    def test_lookup_errors_return_none(self):
+        self.paginator.paginate.side_effect = _client_error('ClusterNotFoundException')
+
+        self.assertIsNone(self.client.get_services('cluster'))
+
+    def test_other_errors_are_raised(self):
+        self.paginator.paginate.side_effect = _client_error('ThrottlingException')
+
+        with self.assertRaises(ClientError):
+            self.client.get_services('cluster')
+
+    def test_iter_services_raises_lookup_error(self):
+        self.paginator.paginate.side_effect = _client_error('AccessDeniedException')
+
+        with self.assertRaises(ServiceLookupError):
+            next(self.client.iter_services('cluster'))
+
+    def test_iter_services_fetches_pages_lazily(self):
+        fetched = []
+
+        def paginate(**kwargs):
+            for page in [{'serviceArns': ['a/web']}, {'serviceArns': ['a/api']}]:
+                fetched.append(page)
+                yield page
+        self.paginator.paginate.side_effect = paginate
+
+        self.assertEqual(next(self.client.iter_services('cluster')), 'a/web')
+        self.assertEqual(len(fetched), 1)
+
+class GetServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = _make_client()
+        self.service = {'serviceArn': 'arn:aws:ecs:us-east-1:123456789012:service/web',
+                        'serviceName': 'web'}
+        self.client.ecs_client.describe_services.return_value = {'services': [self.service]}
+
+    def test_matches_arn(self):
+        self.assertIs(self.client.get_service('cluster', self.service['serviceArn']),
+                      self.service)
+
+    def test_matches_name(self):
+        self.assertIs(self.client.get_service('cluster', 'web'), self.service)
+
+    def test_other_service_returns_none(self):
+        self.assertIsNone(self.client.get_service('cluster', 'api'))
+
+class StopTasksTest(unittest.TestCase):
+
+    def test_failed_stop_does_not_abort_others(self):
+        client = _make_client()
+        client.ecs_client.get_paginator.return_value.paginate.return_value = [
+            {'taskArns': ['task-1', 'task-2', 'task-3']}]
+
+        def stop_task(cluster, task):
+            if task == 'task-2':
+                raise _client_error('InvalidParameterException')
+            return {'task': {'taskArn': task}}
+        client.ecs_client.stop_task.side_effect = stop_task
+
+        stopped = client.stop_tasks_similar_to_task_definition('cluster', TASKDEF_ARN)
+
+        self.assertEqual([task['taskArn'] for task in stopped], ['task-1', 'task-3'])
+        client.ecs_client.describe_task_definition.assert_not_called()
+
+
+class UpdateImageTest(unittest.TestCase):
+
+    def test_missing_task_definition_returns_false(self):
+        client = _make_client()
+        client.ecs_client.describe_services.return_value = {'services': []}
+
+        self.assertFalse(client.update_image('cluster', 'service', 'web', None, 'web:2'))
+        client.ecs_client.update_service.assert_not_called()
+
+    def test_unchanged_revision_forces_new_deployment(self):
+        client = _make_client()
+        client.ecs_client.describe_services.return_value = {'services': [{
+            'serviceArn': 'service', 'serviceName': 'service', 'taskDefinition': TASKDEF_ARN}]}
+        client.ecs_client.list_task_definitions.return_value = {
+            'taskDefinitionArns': [TASKDEF_ARN]}
+        client.ecs_client.get_paginator.return_value.paginate.return_value = []
+        client.ecs_client.describe_task_definition.return_value = \
+            _describe_response([{'name': 'web', 'image': 'web:latest'}])
+        client.ecs_client.update_service.return_value = {'service': {'status': 'ACTIVE'}}
+
+        self.assertTrue(client.update_image('cluster', 'service', 'web', None, 'web:latest'))
+        client.ecs_client.register_task_definition.assert_not_called()
+        client.ecs_client.update_service.assert_called_once_with(
+            cluster='cluster', service='service', taskDefinition=TASKDEF_ARN,
+            forceNewDeployment=True)
+
+
+class PollWithBackoffTest(unittest.TestCase):
+
+    def test_returns_once_predicate_succeeds(self):
+        results = iter([False, False, True])
+        with mock.patch.object(ecs_client.time, 'sleep') as sleep:
+            self.assertTrue(ecs_client._poll_with_backoff(lambda: next(results), 60))
+
+        delays = [call[0][0] for call in sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        # exponential steps, each with at most 25% jitter on top
+        self.assertTrue(1.0 <= delays[0] <= 1.25)
+        self.assertTrue(1.8 <= delays[1] <= 2.25)
+
+    def test_gives_up_without_sleeping_past_timeout(self):
+        with mock.patch.object(ecs_client.time, 'sleep') as sleep:
+            self.assertFalse(ecs_client._poll_with_backoff(lambda: False, 0.5))
+
+        sleep.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()